@@ -7,7 +7,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from langchain_core.messages import HumanMessage, AIMessage
 
 from auth import decode_jwt_token
-from rag.rag_pipeline import load_vectorstore, build_rag_chain, run_query
+from rag.rag_pipeline import load_vectorstore, load_sharded_retriever, build_rag_chain, run_query
 from storage import load_chat_history, save_chat_history, clear_chat_history
 from models import ChatRequest, ChatResponse
 
@@ -48,8 +48,25 @@ async def startup_event():
     global vectorstore_instance, rag_chain_instance
     bucket = os.getenv("GCS_BUCKET_NAME")
     print("✅ RAGチェーンの初期化を開始...")
-    vectorstore_instance = load_vectorstore(bucket)
-    rag_chain_instance = build_rag_chain(vectorstore_instance)
+    # RAG_SHARDS が設定されていればシャード化インデックスを使う
+    # （"all" なら公開済みの全シャード、カンマ区切りならそのシャードだけを担当する）
+    shards = os.getenv("RAG_SHARDS", "").strip()
+    if shards:
+        shard_names = None if shards == "all" else [
+            name.strip() for name in shards.split(",") if name.strip()
+        ]
+        if shard_names == []:
+            raise ValueError(f"RAG_SHARDS に有効なシャード名がありません: {shards!r}")
+        retriever = load_sharded_retriever(
+            bucket,
+            shard_names=shard_names,
+            routing=os.getenv("RAG_SHARD_ROUTING", "router"),
+            top_n_shards=int(os.getenv("RAG_SHARD_TOP_N", 2)),
+        )
+        rag_chain_instance = build_rag_chain(retriever=retriever)
+    else:
+        vectorstore_instance = load_vectorstore(bucket)
+        rag_chain_instance = build_rag_chain(vectorstore_instance)
     print("✅ RAGチェーンの初期化が完了しました。")
 
 
@@ -6,6 +6,9 @@ from langchain_community.vectorstores import FAISS
 from dotenv import load_dotenv
 from google.cloud import storage # ★ GCSライブラリをインポート
 import json # ★ サービスアカウントキーをJSONとしてロードするために必要
+import argparse
+import tempfile
+import numpy as np
 
 load_dotenv()
 
@@ -13,11 +16,17 @@ load_dotenv()
 script_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(script_dir, os.pardir))
 
-DATA_DIR = os.path.join(project_root, "data", "yanbaru") # 生データはローカルから読み込む（後でGCSから読む方法も説明）
+DATA_ROOT = os.path.join(project_root, "data") # ★ シャード化する場合は data/ 直下のサブディレクトリ1つが1シャードになる
+DATA_DIR = os.path.join(DATA_ROOT, "yanbaru") # 生データはローカルから読み込む（後でGCSから読む方法も説明）
 LOCAL_FAISS_DIR = os.path.join(project_root, "faiss_index_temp") # ★ 一時的にローカルに保存するディレクトリ
 
 # ★ GCS関連の設定
 GCS_BUCKET_NAME = "hacktsuai-rag-data-bucket-unique-id" # ★ あなたが作成したGCSバケット名に置き換える
+GCS_INDEX_PREFIX = "faiss_index" # 単一（従来）インデックスのGCS上のプレフィックス
+# ★ シャードは gs://<bucket>/faiss_shards/<シャード名>/ に個別に保存する
+# （"faiss_index" で始まる名前にすると従来インデックスのダウンロード対象に混ざるため別名にする）
+GCS_SHARD_PREFIX = "faiss_shards"
+SHARD_CENTROID_FILENAME = "centroid.json" # ルーティング用の重心ベクトル
 # ★ サービスアカウントキーファイルのパス
 # Codespacesやローカルで実行する場合のパス。本番デプロイでは環境変数で渡すのが一般的。
 # 通常、このキーファイルはGitに含めない。
@@ -48,6 +57,14 @@ def upload_to_gcs(bucket_name, source_directory, destination_blob_prefix):
             print(f"Uploaded {local_file_path} to {gcs_blob_name}")
     print("GCSへのアップロード完了。")
 
+
+def upload_file_to_gcs(bucket_name, local_file_path, gcs_blob_name):
+    """単一ファイルをGCSバケットにアップロードする"""
+    storage_client = storage.Client.from_service_account_json(GCP_SERVICE_ACCOUNT_KEY_PATH)
+    bucket = storage_client.bucket(bucket_name)
+    bucket.blob(gcs_blob_name).upload_from_filename(local_file_path)
+    print(f"Uploaded {local_file_path} to {gcs_blob_name}")
+
 # --- 1. データ読み込み (変更なし) ---
 def load_all_documents(data_dir):
     # ... (既存のコード) ...
@@ -82,7 +99,9 @@ def split_documents_into_chunks(documents):
     return chunks
 
 # --- 3. 埋め込み生成とベクトルストアへの保存（変更あり）---
-def create_and_save_vectorstore(chunks, local_db_path, gcs_bucket_name):
+def create_and_save_vectorstore(chunks, local_db_path, gcs_bucket_name,
+                                gcs_blob_prefix=GCS_INDEX_PREFIX, after_upload=None):
+    """after_upload(vectorstore, local_db_path) を渡すと、インデックスのアップロード完了後・一時ディレクトリ削除前に呼ばれる"""
     print("埋め込みを生成し、ベクトルストアを構築します...")
     embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
     vectorstore = FAISS.from_documents(chunks, embeddings)
@@ -93,7 +112,9 @@ def create_and_save_vectorstore(chunks, local_db_path, gcs_bucket_name):
     print(f"ベクトルストアを一時的にローカルの {local_db_path} に保存しました。")
 
     # 次にGCSにアップロード
-    upload_to_gcs(gcs_bucket_name, local_db_path, "faiss_index") # GCS上のプレフィックス（フォルダ名）
+    upload_to_gcs(gcs_bucket_name, local_db_path, gcs_blob_prefix) # GCS上のプレフィックス（フォルダ名）
+    if after_upload is not None:
+        after_upload(vectorstore, local_db_path)
     
     # 一時的なローカルディレクトリをクリーンアップ（任意）
     import shutil
@@ -102,7 +123,71 @@ def create_and_save_vectorstore(chunks, local_db_path, gcs_bucket_name):
 
     return vectorstore
 
+# --- 4. シャード単位のベクトルストア構築 ---
+def list_shard_names(data_root):
+    """data_root 直下のサブディレクトリ名（＝シャード名）を返す"""
+    return sorted(
+        name for name in os.listdir(data_root)
+        if os.path.isdir(os.path.join(data_root, name)) and not name.startswith(".")
+    )
+
+
+def publish_shard_centroid(vectorstore, shard_name, local_db_path, gcs_bucket_name):
+    """シャード内の全ベクトルの平均（重心）をルーター用に保存し、GCSにアップロードする
+
+    rag_pipeline.list_shards は重心ファイルの有無で公開済みかを判定するため、
+    インデックス本体のアップロードが終わった後、最後にアップロードすること。
+    """
+    index = vectorstore.index
+    vectors = index.reconstruct_n(0, index.ntotal)
+    centroid = np.asarray(vectors, dtype="float32").mean(axis=0)
+    centroid_path = os.path.join(local_db_path, SHARD_CENTROID_FILENAME)
+    with open(centroid_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "name": shard_name,
+            "num_vectors": int(index.ntotal),
+            "centroid": centroid.tolist(),
+        }, f)
+    print(f"シャード '{shard_name}' の重心を {centroid_path} に保存しました。")
+    upload_file_to_gcs(
+        gcs_bucket_name, centroid_path,
+        f"{GCS_SHARD_PREFIX}/{shard_name}/{SHARD_CENTROID_FILENAME}")
+    print(f"シャード '{shard_name}' を公開しました。")
+
+
+def create_and_save_shard(shard_name, data_root, gcs_bucket_name):
+    """1つのシャードを構築し、他のシャードとは独立してGCSに公開する"""
+    print(f"\n=== シャード '{shard_name}' の構築を開始します ===")
+    documents = load_all_documents(os.path.join(data_root, shard_name))
+    if not documents:
+        print(f"警告: シャード '{shard_name}' にドキュメントがないためスキップします。")
+        return None
+    chunks = split_documents_into_chunks(documents)
+
+    # 一時ディレクトリは create_and_save_vectorstore の最後で削除される
+    return create_and_save_vectorstore(
+        chunks,
+        tempfile.mkdtemp(prefix=f"faiss_shard_{shard_name}_"),
+        gcs_bucket_name,
+        gcs_blob_prefix=f"{GCS_SHARD_PREFIX}/{shard_name}",
+        after_upload=lambda vectorstore, local_db_path: publish_shard_centroid(
+            vectorstore, shard_name, local_db_path, gcs_bucket_name),
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="RAG用ベクトルインデックスを構築してGCSに保存します。")
+    parser.add_argument(
+        "--shards",
+        nargs="*",
+        metavar="NAME",
+        help="data/ 直下のサブディレクトリごとにシャードを構築する。名前を省略すると全サブディレクトリを対象にする。",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
     print("データ取り込みプロセスを開始します...")
     # 環境変数 GCP_SERVICE_ACCOUNT_KEY_JSON が設定されている場合、その情報で認証
     if GCP_SERVICE_ACCOUNT_KEY_JSON:
@@ -114,7 +199,22 @@ if __name__ == "__main__":
         print("GCP_SERVICE_ACCOUNT_KEY_PATH を正しく設定するか、環境変数 GCP_SERVICE_ACCOUNT_KEY_JSON を設定してください。")
         exit(1)
 
-    documents = load_all_documents(DATA_DIR)
-    chunks = split_documents_into_chunks(documents)
-    create_and_save_vectorstore(chunks, LOCAL_FAISS_DIR, GCS_BUCKET_NAME)
+    if args.shards is not None:
+        available = list_shard_names(DATA_ROOT)
+        shard_names = args.shards or available
+        if not shard_names:
+            print(f"エラー: {DATA_ROOT} にシャード用のサブディレクトリがありません。")
+            exit(1)
+        # data/ 直下のサブディレクトリ名以外（"a/b" や "../x" など）は受け付けない
+        for shard_name in shard_names:
+            if shard_name not in available:
+                print(f"エラー: シャード名は {DATA_ROOT} 直下のサブディレクトリ名を指定してください: {shard_name}")
+                print(f"利用可能なシャード: {', '.join(available) or 'なし'}")
+                exit(1)
+        for shard_name in shard_names:
+            create_and_save_shard(shard_name, DATA_ROOT, GCS_BUCKET_NAME)
+    else:
+        documents = load_all_documents(DATA_DIR)
+        chunks = split_documents_into_chunks(documents)
+        create_and_save_vectorstore(chunks, LOCAL_FAISS_DIR, GCS_BUCKET_NAME)
     print("データ取り込みプロセスが完了しました！")
\ No newline at end of file
@@ -1,10 +1,19 @@
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+import numpy as np
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_community.vectorstores import FAISS
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import PrivateAttr
 from dotenv import load_dotenv
 from google.cloud import storage
 import json
@@ -21,16 +30,17 @@ project_root = os.path.abspath(os.path.join(
 
 # ★ GCS関連の設定
 GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+# ★ シャード化インデックスの保存先（rag/ingest.py --shards と合わせる）
+GCS_SHARD_PREFIX = "faiss_shards"
+SHARD_CENTROID_FILENAME = "centroid.json"
 
 # ★ GCP認証情報の設定
 GCP_SERVICE_ACCOUNT_KEY_JSON = os.getenv("GCP_SERVICE_ACCOUNT_KEY_JSON")
 GCP_SERVICE_ACCOUNT_KEY_BASE64 = os.getenv("GCP_SERVICE_ACCOUNT_KEY_BASE64")
 
 
-def download_from_gcs(bucket_name, source_blob_prefix, destination_directory):
-    """GCSバケットからファイルをダウンロードする"""
-    print(f"GCSからファイルをダウンロード中: gs://{bucket_name}/{source_blob_prefix}/")
-
+def get_storage_client():
+    """環境変数の認証情報からGCSクライアントを作成する"""
     storage_client = None
     service_account_info = None
 
@@ -73,7 +83,14 @@ def download_from_gcs(bucket_name, source_blob_prefix, destination_directory):
 
     if storage_client is None:
         raise ValueError("ストレージクライアントの初期化に失敗しました。")
+    return storage_client
+
 
+def download_from_gcs(bucket_name, source_blob_prefix, destination_directory):
+    """GCSバケットからファイルをダウンロードする"""
+    print(f"GCSからファイルをダウンロード中: gs://{bucket_name}/{source_blob_prefix}/")
+
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(bucket_name)
     blobs = bucket.list_blobs(prefix=source_blob_prefix)
 
@@ -92,14 +109,15 @@ def download_from_gcs(bucket_name, source_blob_prefix, destination_directory):
 
 
 # --- 1. ベクトルストアの読み込み ---
-def load_vectorstore(gcs_bucket_name, gcs_blob_prefix="faiss_index"):
+def load_vectorstore(gcs_bucket_name, gcs_blob_prefix="faiss_index", embeddings=None):
     temp_dir = tempfile.mkdtemp()
     print(f"一時ディレクトリ: {temp_dir}")
     try:
         download_from_gcs(gcs_bucket_name, gcs_blob_prefix, temp_dir)
 
         print(f"ベクトルストアを {temp_dir} から読み込みます...")
-        embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
+        if embeddings is None:
+            embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
         vectorstore = FAISS.load_local(
             temp_dir, embeddings, allow_dangerous_deserialization=True)
         print("ベクトルストアの読み込みが完了しました。")
@@ -109,9 +127,188 @@ def load_vectorstore(gcs_bucket_name, gcs_blob_prefix="faiss_index"):
         print(f"一時ディレクトリ {temp_dir} を削除しました。")
 
 
+# --- 1b. シャード化ベクトルストアの読み込み ---
+def list_shards(gcs_bucket_name, shard_prefix=GCS_SHARD_PREFIX):
+    """GCS上に公開済みのシャード名（重心ファイルがあるもの）を返す"""
+    bucket = get_storage_client().bucket(gcs_bucket_name)
+    shard_names = []
+    for blob in bucket.list_blobs(prefix=f"{shard_prefix}/"):
+        parts = blob.name[len(shard_prefix) + 1:].split("/")
+        if len(parts) == 2 and parts[1] == SHARD_CENTROID_FILENAME:
+            shard_names.append(parts[0])
+    return sorted(shard_names)
+
+
+def load_shard_centroids(gcs_bucket_name, shard_names, shard_prefix=GCS_SHARD_PREFIX):
+    """ルーティング用に各シャードの重心ベクトルだけを読み込む（インデックス本体は読み込まない）"""
+    bucket = get_storage_client().bucket(gcs_bucket_name)
+    centroids = {}
+    for shard_name in shard_names:
+        blob = bucket.blob(f"{shard_prefix}/{shard_name}/{SHARD_CENTROID_FILENAME}")
+        data = json.loads(blob.download_as_text())
+        centroids[shard_name] = np.asarray(data["centroid"], dtype="float32")
+    return centroids
+
+
+class ShardedRetriever(BaseRetriever):
+    """複数のシャードから検索し、スコア順に上位k件を返すリトリーバー
+
+    routing="router" の場合はクエリと各シャードの重心とのコサイン類似度で
+    上位 top_n_shards 個のシャードだけを検索し、"fanout" の場合は全シャードを並列に検索する。
+    シャード本体は初めて検索対象になった時点でGCSから読み込む。
+    """
+
+    gcs_bucket_name: str
+    shard_names: List[str]
+    shard_prefix: str = GCS_SHARD_PREFIX
+    embeddings: Any
+    centroids: Dict[str, Any] = {}
+    routing: str = "router"
+    top_n_shards: int = 2
+    k: int = 3
+    max_workers: int = 4
+    retry_interval: float = 300.0  # 読み込みに失敗したシャードを再試行するまでの秒数
+
+    _shards: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    _shard_locks: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    _shard_failures: Dict[str, float] = PrivateAttr(default_factory=dict)
+    _executor: Any = PrivateAttr(default=None)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.routing not in ("router", "fanout"):
+            raise ValueError(f"routing は 'router' または 'fanout' を指定してください: {self.routing}")
+        if self.top_n_shards < 1:
+            raise ValueError(f"top_n_shards は1以上を指定してください: {self.top_n_shards}")
+        if not self.shard_names:
+            raise ValueError("shard_names に1つ以上のシャードを指定してください。")
+        if self.max_workers < 1:
+            raise ValueError(f"max_workers は1以上を指定してください: {self.max_workers}")
+        if self.routing == "router":
+            missing = [name for name in self.shard_names if name not in self.centroids]
+            if missing:
+                raise ValueError(f"重心が指定されていないシャードがあります: {', '.join(missing)}")
+        self._shard_locks = {name: threading.Lock() for name in self.shard_names}
+        # 全リクエストで共有するスレッドプール（リクエストごと・シャードごとにスレッドを作らない）
+        self._executor = ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(self.shard_names)))
+
+    def get_shard(self, shard_name):
+        """シャードを返す。未読み込みならここで読み込む（同じシャードの同時読み込みは1回にまとめる）
+
+        読み込みに失敗したシャードは retry_interval 秒経つまで再ダウンロードせずにエラーにする。
+        """
+        shard = self._shards.get(shard_name)
+        if shard is not None:
+            return shard
+        with self._shard_locks[shard_name]:
+            shard = self._shards.get(shard_name)
+            if shard is not None:
+                return shard
+
+            failed_at = self._shard_failures.get(shard_name)
+            if failed_at is not None and time.monotonic() - failed_at < self.retry_interval:
+                raise RuntimeError(
+                    f"シャード '{shard_name}' は読み込みに失敗したため、再試行を待機中です。")
+
+            print(f"シャード '{shard_name}' を読み込みます...")
+            try:
+                shard = load_vectorstore(
+                    self.gcs_bucket_name,
+                    f"{self.shard_prefix}/{shard_name}/",
+                    embeddings=self.embeddings,
+                )
+            except Exception:
+                self._shard_failures[shard_name] = time.monotonic()
+                raise
+            self._shard_failures.pop(shard_name, None)
+            self._shards[shard_name] = shard
+        return shard
+
+    def route(self, query_vector):
+        """検索対象のシャード名を返す"""
+        if self.routing == "fanout":
+            return list(self.shard_names)
+
+        query = np.asarray(query_vector, dtype="float32")
+        matrix = np.stack([self.centroids[name] for name in self.shard_names])
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        similarities = matrix @ query / np.where(norms == 0, 1, norms)
+        order = np.argsort(-similarities)[:self.top_n_shards]
+        return [self.shard_names[i] for i in order]
+
+    def _search_shard(self, shard_name, query_vector):
+        """1シャードを検索する。失敗しても他のシャードの結果は使えるよう None を返す"""
+        try:
+            shard = self.get_shard(shard_name)
+            results = shard.similarity_search_with_score_by_vector(query_vector, k=self.k)
+        except Exception as e:
+            print(f"ERROR: シャード '{shard_name}' の検索に失敗しました: {e}")
+            return None
+        # docstore 内の Document を書き換えないようコピーにシャード名を付ける
+        return [
+            (Document(page_content=doc.page_content,
+                      metadata={**doc.metadata, "shard": shard_name}), score)
+            for doc, score in results
+        ]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # 埋め込みは1回だけ計算し、ルーティングと全シャードの検索で使い回す
+        query_vector = self.embeddings.embed_query(query)
+        target_shards = self.route(query_vector)
+
+        shard_results = list(self._executor.map(
+            lambda name: self._search_shard(name, query_vector), target_shards))
+        succeeded = [results for results in shard_results if results is not None]
+        # 一部のシャードだけが失敗した場合は残りの結果で答え、全滅した場合は空のコンテキストで答えずにエラーにする
+        if not succeeded:
+            raise RuntimeError(
+                f"検索対象のすべてのシャードで検索に失敗しました: {', '.join(target_shards)}")
+        merged = [result for results in succeeded for result in results]
+
+        # 全シャード同じ埋め込みモデル・L2距離なので、スコア（距離）が小さい順にそのまま比較できる
+        merged.sort(key=lambda result: result[1])
+        return [doc for doc, _ in merged[:self.k]]
+
+
+def load_sharded_retriever(gcs_bucket_name, shard_names=None, shard_prefix=GCS_SHARD_PREFIX,
+                           routing="router", top_n_shards=2, k=3):
+    """シャード化インデックス用のリトリーバーを作成する（シャード本体は遅延読み込み）"""
+    published = list_shards(gcs_bucket_name, shard_prefix)
+    if shard_names is None:
+        shard_names = published
+    if not shard_names:
+        raise ValueError(f"シャードが見つかりません: gs://{gcs_bucket_name}/{shard_prefix}/")
+    missing = [name for name in shard_names if name not in published]
+    if missing:
+        raise ValueError(
+            f"公開されていないシャードが指定されています: {', '.join(missing)} "
+            f"(gs://{gcs_bucket_name}/{shard_prefix}/ にあるシャード: {', '.join(published) or 'なし'})")
+    print(f"対象シャード: {', '.join(shard_names)}（ルーティング: {routing}）")
+
+    centroids = {}
+    if routing == "router":
+        centroids = load_shard_centroids(gcs_bucket_name, shard_names, shard_prefix)
+
+    return ShardedRetriever(
+        gcs_bucket_name=gcs_bucket_name,
+        shard_names=list(shard_names),
+        shard_prefix=shard_prefix,
+        embeddings=OpenAIEmbeddings(model="text-embedding-ada-002"),
+        centroids=centroids,
+        routing=routing,
+        top_n_shards=top_n_shards,
+        k=k,
+    )
+
+
 # --- 2. RAGチェーンの構築 ---
-def build_rag_chain(vectorstore):
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
+def build_rag_chain(vectorstore=None, retriever=None):
+    """vectorstore から検索するか、retriever（ShardedRetriever など）を直接使う"""
+    if retriever is None:
+        retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
     llm = ChatOpenAI(model="gpt-4o", temperature=0.5)
 
     # ★ ここから追記（ドメイン前提知識）----------------------------------------